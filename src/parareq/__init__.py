@@ -1,9 +1,19 @@
 # read version from installed package
 from importlib.metadata import version
-from parareq.parareq import APIRequestProcessor
 
 __version__ = version("parareq")
 
-from parareq import parareq
-
 __all__ = ["parareq", "APIRequestProcessor"]
+
+
+def __getattr__(name):
+    # PEP 562: load the processor (and aiohttp with it) only on first use
+    if name == "APIRequestProcessor":
+        from parareq.parareq import APIRequestProcessor
+
+        return APIRequestProcessor
+    if name == "parareq":
+        import importlib
+
+        return importlib.import_module("parareq.parareq")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -19,9 +19,7 @@ Example command to call script:
 import argparse
 import logging
 import os
-from parareq.parareq import APIRequestProcessor
-from parareq.utils import create_requests_file
-from dotenv import load_dotenv
+from pathlib import Path
 
 
 def look_for_api_key(args):
@@ -37,28 +35,28 @@ def look_for_api_key(args):
         raise ValueError(f"Unknown API {which_api}")
 
     if args.api_key is None:
-        for var in env_vars:
-            try:
-                args.api_key = os.environ[var]
-                return
-            except KeyError:
-                print(f"No api key for environment variables {var}")
-        print(f"No api key in environment variables, trying .env file...")
+        # load_dotenv does not override variables that are already set
+        from dotenv import load_dotenv
+
         load_dotenv()
-        for var in env_vars:
-            try:
-                args.api_key = os.environ[var]
-                return
-            except KeyError:
-                print(f"No api key for {var} in .env file.")
-
-        raise ValueError(
-            "API key must be provided via either cli arg, env var, or .env file"
+        args.api_key = next(
+            (key for key in (os.getenv(var) for var in env_vars) if key), None
         )
+        if args.api_key is None:
+            raise ValueError(
+                f"API key must be provided via either cli arg, env var "
+                f"({' or '.join(env_vars)}), or .env file"
+            )
 
 
-def cli():
-    """Handles the CLI UI"""
+def _default_save_filepath(requests_filepath: str) -> str:
+    """Name the results file after the requests file: foo.jsonl -> foo_results.jsonl"""
+    path = Path(requests_filepath)
+    return str(path.with_name(path.stem + "_results" + path.suffix))
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    """Define the CLI arguments."""
     parser = argparse.ArgumentParser()
     parser.add_argument("--requests_filepath")
     parser.add_argument("--save_filepath", default=None)
@@ -74,18 +72,37 @@ def cli():
     parser.add_argument("--max_tokens_per_minute", type=int, default=90_000 * 0.75)
     parser.add_argument("--token_encoding_name", default="cl100k_base")
     parser.add_argument("--max_attempts", type=int, default=5)
+    parser.add_argument("--max_inflight", type=int, default=None)
+    parser.add_argument("--request_timeout", type=float, default=60)
     parser.add_argument("--logging_level", default=logging.INFO)
-    parser.add_argument("--create_requests_file", type=bool, default=False)
+    # type=bool would treat any non-empty string, "False" included, as True
+    parser.add_argument(
+        "--create_requests_file", action=argparse.BooleanOptionalAction, default=False
+    )
     parser.add_argument(
-        "--dry_run", type=bool, action=argparse.BooleanOptionalAction, default=False
+        "--dry_run", action=argparse.BooleanOptionalAction, default=False
     )
+    parser.add_argument(
+        "--use_cache", action=argparse.BooleanOptionalAction, default=False
+    )
+    return parser
 
-    args = parser.parse_args()
+
+def cli():
+    """Handles the CLI UI"""
+    args = _build_parser().parse_args()
+    logging.basicConfig(
+        level=int(args.logging_level),
+        format="%(asctime)s  - %(levelname)s - %(message)s",
+    )
 
     if args.save_filepath is None:
-        args.save_filepath = args.requests_filepath.replace(".jsonl", "_results.jsonl")
+        args.save_filepath = _default_save_filepath(args.requests_filepath)
 
+    # heavy imports (aiohttp, tiktoken) are deferred until the arguments are valid
     if args.create_requests_file:
+        from parareq.utils import create_requests_file
+
         create_requests_file()
         exit()
 
@@ -95,6 +112,8 @@ def cli():
 
     look_for_api_key(args)
 
+    from parareq.parareq import APIRequestProcessor
+
     processor = APIRequestProcessor(
         save_filepath=args.save_filepath,
         request_url=args.request_url,
@@ -104,7 +123,10 @@ def cli():
         max_tokens_per_minute=float(args.max_tokens_per_minute),
         token_encoding_name=args.token_encoding_name,
         max_attempts=int(args.max_attempts),
+        max_inflight=args.max_inflight,
         logging_level=int(args.logging_level),
+        use_cache=args.use_cache,
+        request_timeout=args.request_timeout,
     )
     if args.dry_run:
         print("Dry run complete")
@@ -4,41 +4,112 @@
         - api_endpoint_from_url (extracts API endpoint from request URL)
 """
 
+import functools
+import os
 import re  # for matching endpoint from request URL
 import json
-import tiktoken
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable
 
+if TYPE_CHECKING:
+    import tiktoken
 
-def openai_api_endpoint_from_url(request_url: str) -> str:
-    """Extract the API endpoint from the request URL."""
+# matches each "<number><unit>" part of a reset duration such as "1m30.5s"
+RESET_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+RESET_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
 
-    # ^https://    -> Starts with "https://"
-    # [^/]+/       -> root string followed by a forward slash "api.openai.com/"
-    # v\\d+/       -> Matches "v[some_number]/"
-    # (.+)$        -> Captures the rest of the string
+# tiktoken's batch encoders tokenize in parallel in Rust, outside the GIL, but
+# start a thread pool on every call. That only pays off for lists of texts
+# with at least this many characters in total; smaller ones are encoded in turn.
+# The *_ordinary variants skip the special-token scan, which a count doesn't need
+ENCODE_NUM_THREADS = os.cpu_count() or 1
+BATCH_ENCODE_MIN_CHARS = 1 << 16
 
-    match = re.search("^https://[^/]+/v\\d+/(.+)$", request_url)
-    if match is not None and len(match.groups()) > 0:
-        print("match groups: ", match.groups())
-        return match[1]
-    else:
+# embedding inputs up to this many characters are counted through the memoized
+# _count_tokens, as short inputs (labels, keywords) tend to repeat across a corpus
+SHORT_INPUT_MAX_CHARS = 64
+
+# likewise for chat message contents: enough for a shared system prompt, while
+# long unique documents are encoded directly rather than kept alive in the cache
+CACHED_MESSAGE_MAX_CHARS = 4096
+
+
+def openai_api_endpoint_from_url(request_url: str) -> str:
+    """Extract the API endpoint from the request URL.
 
+    The URL must look like https://{host}/v{number}/{endpoint}, e.g.
+    https://api.openai.com/v1/chat/completions -> "chat/completions".
+    """
+    scheme, _, rest = request_url.partition("://")
+    host, _, rest = rest.partition("/")
+    version, _, endpoint = rest.partition("/")
+    if (
+        scheme == "https"
+        and host
+        and version[:1] == "v"
+        and version[1:].isdigit()
+        and endpoint
+    ):
+        return endpoint
+    else:
         raise ValueError(
             f"No matches found, URL doesn't match structure: {request_url}"
         )
 
 
+@functools.lru_cache(maxsize=8)
+def _get_encoding(token_encoding_name: str) -> "tiktoken.Encoding":
+    """Load a tiktoken encoding once per name and reuse it for every request."""
+    # imported here so that `import parareq` and `parareq --help` stay fast
+    import tiktoken
+
+    return tiktoken.get_encoding(token_encoding_name)
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_tokens(encoding: "tiktoken.Encoding", text: str) -> int:
+    """Count tokens in one string, memoized for text that repeats across requests
+    (e.g. a shared system prompt). Encodings are cached, so identity is a safe key."""
+    return len(encoding.encode_ordinary(text))
+
+
+def _count_tokens_in_texts(encoding: "tiktoken.Encoding", texts: list) -> int:
+    """Count the tokens in a list of strings, batching only large lists."""
+    if sum(map(len, texts)) >= BATCH_ENCODE_MIN_CHARS:
+        encoded = encoding.encode_ordinary_batch(texts, num_threads=ENCODE_NUM_THREADS)
+        return sum(map(len, encoded))
+    encode = encoding.encode_ordinary
+    return sum(len(encode(text)) for text in texts)
+
+
+def parse_reset_duration(duration: str) -> float:
+    """Convert an x-ratelimit-reset-* header value like "6s" or "1m30s" to seconds."""
+    parts = RESET_DURATION_PART_RE.findall(duration)
+    if not parts or "".join(n + unit for n, unit in parts) != duration.strip():
+        raise ValueError(f"Can't parse rate limit reset duration: {duration}")
+    return sum(float(n) * RESET_DURATION_UNITS[unit] for n, unit in parts)
+
+
 def count_embedding_tokens(
-    encoding: tiktoken.Encoding, request_json: dict, api_endpoint: str
+    encoding: "tiktoken.Encoding", request_json: dict, api_endpoint: str
 ) -> int:
     """embeddings request: tokens = input tokens"""
     input = request_json["input"]
     if isinstance(input, str):  # single input
-        num_tokens = len(encoding.encode(input))
+        if len(input) <= SHORT_INPUT_MAX_CHARS:
+            return _count_tokens(encoding, input)
+        num_tokens = len(encoding.encode_ordinary(input))
         return num_tokens
     elif isinstance(input, list):  # multiple inputs
-        num_tokens = sum([len(encoding.encode(i)) for i in input])
+        num_tokens = 0
+        long_inputs = []
+        for text in input:
+            if len(text) <= SHORT_INPUT_MAX_CHARS:
+                num_tokens += _count_tokens(encoding, text)
+            else:
+                long_inputs.append(text)
+        if long_inputs:
+            num_tokens += _count_tokens_in_texts(encoding, long_inputs)
         return num_tokens
     else:
         raise TypeError(
@@ -47,7 +118,7 @@ def count_embedding_tokens(
 
 
 def count_completion_tokens(
-    encoding: tiktoken.Encoding, request_json: dict, api_endpoint: str
+    encoding: "tiktoken.Encoding", request_json: dict, api_endpoint: str
 ) -> int:
     """completions request: tokens = prompt + n * max_tokens"""
     max_tokens = request_json.get("max_tokens", 15)
@@ -56,26 +127,32 @@ def count_completion_tokens(
 
     # chat completions
     if api_endpoint.startswith("chat/"):
-        num_tokens = 0
-        for message in request_json["messages"]:
-            num_tokens += (
-                4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            )
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens -= 1  # role is always required and always 1 token
+        messages = request_json["messages"]
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 4 * len(messages)
+        for message in messages:
+            num_tokens += _count_tokens(encoding, message["role"])
+            # content is null on assistant messages that only call tools
+            content = message.get("content")
+            if content and len(content) <= CACHED_MESSAGE_MAX_CHARS:
+                num_tokens += _count_tokens(encoding, content)
+            elif content:
+                num_tokens += len(encoding.encode_ordinary(content))
+            name = message.get("name")
+            if name is not None:  # if there's a name, the role is omitted
+                # role is always required and always 1 token
+                num_tokens += _count_tokens(encoding, name) - 1
         num_tokens += 2  # every reply is primed with <im_start>assistant
         return num_tokens + completion_tokens
     # normal completions
     else:
         prompt = request_json["prompt"]
         if isinstance(prompt, str):  # single prompt
-            prompt_tokens = len(encoding.encode(prompt))
+            prompt_tokens = len(encoding.encode_ordinary(prompt))
             num_tokens = prompt_tokens + completion_tokens
             return num_tokens
         elif isinstance(prompt, list):  # multiple prompts
-            prompt_tokens = sum([len(encoding.encode(p)) for p in prompt])
+            prompt_tokens = _count_tokens_in_texts(encoding, prompt)
             num_tokens = prompt_tokens + completion_tokens * len(prompt)
             return num_tokens
         else:
@@ -84,23 +161,44 @@ def count_completion_tokens(
             )
 
 
+_TOKEN_COUNTERS = {
+    "embeddings": count_embedding_tokens,
+    "completions": count_completion_tokens,
+    "chat/completions": count_completion_tokens,
+}
+
+
+def openai_token_counter(
+    api_endpoint: str, token_encoding_name: str
+) -> Callable[[dict], int]:
+    """Resolve the token counter for an endpoint once, rather than per request.
+
+    Returns a function that counts the tokens in one request to api_endpoint.
+    The encoding is only loaded when the first request is counted.
+    """
+    counter = _TOKEN_COUNTERS.get(api_endpoint)
+    if counter is None and api_endpoint.endswith("completions"):
+        counter = count_completion_tokens  # e.g. engines/{engine}/completions
+    # more logic needed to support other API calls (e.g., edits, inserts, DALL-E)
+    if counter is None:
+        raise NotImplementedError(
+            f'API endpoint "{api_endpoint}" not implemented in this script'
+        )
+
+    def count_tokens(request_json: dict) -> int:
+        return counter(
+            request_json=request_json,
+            encoding=_get_encoding(token_encoding_name),
+            api_endpoint=api_endpoint,
+        )
+
+    return count_tokens
+
+
 def openai_num_tokens_consumed_from_request(
     request_json: dict,
     api_endpoint: str,
     token_encoding_name: str,
 ) -> int:
     """Count the number of tokens in the request. Only supports completion and embedding requests."""
-    encoding = tiktoken.get_encoding(token_encoding_name)
-    if api_endpoint.endswith("completions"):
-        return count_completion_tokens(
-            request_json=request_json, encoding=encoding, api_endpoint=api_endpoint
-        )
-    elif api_endpoint == "embeddings":
-        return count_embedding_tokens(
-            request_json=request_json, encoding=encoding, api_endpoint=api_endpoint
-        )
-    # more logic needed to support other API calls (e.g., edits, inserts, DALL-E)
-    else:
-        raise NotImplementedError(
-            f'API endpoint "{api_endpoint}" not implemented in this script'
-        )
+    return openai_token_counter(api_endpoint, token_encoding_name)(request_json)
@@ -17,9 +17,14 @@ Features:
 """
 
 import asyncio  # for running API calls concurrently
-import json  # for saving results to a jsonl file
+import heapq  # for ordering retries by when they are due
+import itertools  # for reading the requests file in batches
 import logging  # for logging rate limit warnings and other messages
 import os  # for reading API key
+import random  # for jittering retry backoff
+import shelve  # for the optional on-disk response cache
+import sys  # for checking the Python version
+import threading  # for sharing the response cache between worker threads
 
 import time  # for sleeping after rate limit is hit
 from pathlib import Path
@@ -28,19 +33,55 @@ from dataclasses import (  # for storing API inputs, outputs, and metadata
     field,
 )
 import aiohttp  # for making API calls concurrently
-from typing import Optional  # for optional arguments
+from typing import Callable, Optional  # for optional arguments
 
 from parareq.utils import (
     create_task_id_generator,
     nonduplicate_filename,
-    append_to_jsonl,
+    iter_jsonl,
+    json_dumps,
+    json_loads,
+    JsonlWriter,
+    parse_retry_after,
+    request_cache_key,
 )
 from parareq.openai_utils import (
     openai_api_endpoint_from_url,
-    openai_num_tokens_consumed_from_request,
+    openai_token_counter,
+    parse_reset_duration,
 )
 from parareq.rate_limiter import RateLimiter
 
+try:  # uvloop (0.18+) is optional, asyncio's own event loop is used as a fallback
+    from uvloop import run as uvloop_run
+except ImportError:  # pragma: no cover
+    uvloop_run = None
+
+logger = logging.getLogger(__name__)
+
+# per-request dataclasses drop their __dict__ where dataclasses support it (3.10+)
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# failed requests wait RETRY_BACKOFF_SECONDS * 2 ** (failures - 1) before retrying
+RETRY_BACKOFF_SECONDS = 1.0
+MAX_RETRY_BACKOFF_SECONDS = 60.0
+# plus up to RETRY_JITTER_SECONDS at random, so requests that failed together
+# (e.g. on one 429) don't all come back at the same moment
+RETRY_JITTER_SECONDS = 1.0
+
+# the requests file is read ahead in a worker thread, READ_BATCH_SIZE lines at
+# a time, into a queue holding at most READ_QUEUE_SIZE decoded requests
+READ_BATCH_SIZE = 256
+READ_QUEUE_SIZE = 4096
+
+# while capacity lasts, the loop dispatches up to this many requests in a row
+# before yielding to the event loop, so refilled capacity is used in one burst
+DISPATCH_BURST_SIZE = 64
+
+# written results are flushed to the file at least this often, so a long run
+# shows its progress on disk without a write syscall per result
+WRITE_FLUSH_SECONDS = 1.0
+
 
 @dataclass
 class OpenAISettings:
@@ -58,7 +99,7 @@ class OpenAISettings:
     embedding_secs_in_rate_period: int = 60
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class StatusTracker:
     """Stores metadata about the script's progress. Only one instance is created."""
 
@@ -71,8 +112,9 @@ class StatusTracker:
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
 
-    # used to cool off after hitting rate limits
+    # used to cool off after hitting rate limits (time.monotonic() seconds)
     last_rate_error_time: float = 0
+    retry_after: Optional[float] = None  # pause requested by the server, if any
 
     def task_started(self):
         self.num_tasks_started += 1
@@ -86,15 +128,142 @@ class StatusTracker:
         self.num_tasks_failed += 1
         self.num_tasks_in_progress -= 1
 
-    def had_rate_limit_error(self):
-        self.last_rate_error_time = time.time()
+    def had_rate_limit_error(self, retry_after: Optional[float] = None):
+        self.last_rate_error_time = time.monotonic()
+        self.retry_after = retry_after
         self.num_rate_limit_errors += 1
 
     def had_api_error(self):
         self.num_api_errors += 1
 
 
-@dataclass
+class RetryQueue:
+    """Holds failed requests until their backoff has elapsed, soonest due first.
+
+    Requests wait here instead of sleeping inside their task, and the main loop
+    picks up whichever request is due next.
+    """
+
+    def __init__(self):
+        self._heap = []  # (due time, task_id, request)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put(self, request: "APIRequest", delay: float = 0.0) -> None:
+        due_time = time.monotonic() + delay
+        heapq.heappush(self._heap, (due_time, request.task_id, request))
+
+    def seconds_until_due(self) -> Optional[float]:
+        """Seconds until the soonest retry is due, or None if there are none."""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def pop_due(self) -> Optional["APIRequest"]:
+        """Return the request that is due soonest if it is due now, else None."""
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            return heapq.heappop(self._heap)[2]
+        return None
+
+
+class ResponseCache:
+    """On-disk store of API responses, keyed by request_cache_key.
+
+    Responses are looked up by the requests reader and stored by the
+    BackgroundWriter, each in its own worker thread, so every access to the
+    underlying shelf holds a lock.
+    """
+
+    def __init__(self, filename: str):
+        self._shelf = shelve.open(filename)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            return self._shelf.get(key)
+
+    def put(self, key: str, response) -> None:
+        with self._lock:
+            self._shelf[key] = response
+
+    def close(self) -> None:
+        with self._lock:
+            self._shelf.close()
+
+
+class BackgroundWriter:
+    """Writes result rows to a JsonlWriter from a worker thread, in batches.
+
+    Requests hand their rows over with write(), which only queues them. A
+    single task drains the queue and passes each batch to the JsonlWriter in a
+    worker thread, so serialization and disk writes never block the event loop.
+    Responses to be cached are stored in response_cache the same way.
+    Rows are flushed to the file at most flush_interval seconds after they are
+    written. Use it as an async context manager: leaving it writes all queued rows.
+    """
+
+    def __init__(
+        self,
+        writer: JsonlWriter,
+        response_cache: Optional[ResponseCache] = None,
+        flush_interval: float = WRITE_FLUSH_SECONDS,
+    ):
+        self.filename = writer.filename
+        self.response_cache = response_cache
+        self.flush_interval = flush_interval
+        self._writer = writer
+        # (row, cache key) pairs; None closes
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def write(self, data, cache_key: Optional[str] = None) -> None:
+        """Queue a row; with a cache_key, its response (data[1]) is cached too."""
+        self._queue.put_nowait((data, cache_key))
+
+    async def _drain(self) -> None:
+        last_flush = time.monotonic()
+        dirty = False  # rows were written since the last flush
+        while True:
+            timeout = None  # with nothing to flush, wait for rows indefinitely
+            if dirty:
+                timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+            try:
+                batch = [await asyncio.wait_for(self._queue.get(), timeout)]
+            except asyncio.TimeoutError:
+                batch = []  # no rows for a while: flush what was written
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            closing = bool(batch) and batch[-1] is None  # nothing after the close
+            if closing:
+                batch.pop()
+            flush = time.monotonic() - last_flush >= self.flush_interval
+            if batch or (dirty and flush):
+                await asyncio.to_thread(self._write_batch, batch, flush)
+                dirty = not flush
+                if flush:
+                    last_flush = time.monotonic()
+            if closing:
+                return
+
+    def _write_batch(self, batch: list, flush: bool = False) -> None:
+        for data, cache_key in batch:
+            self._writer.write(data)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, data[1])
+        if flush:
+            self._writer.flush()
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._drain())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._queue.put_nowait(None)
+        await self._task
+
+
+@dataclass(**DATACLASS_SLOTS)
 class APIRequest:
     """Stores an API request's inputs, outputs, and other metadata. Contains a method to make an API call."""
 
@@ -108,73 +277,116 @@ class APIRequest:
 
     async def call_api(
         self,
+        session: aiohttp.ClientSession,
         request_url: str,
-        request_header: dict,
-        retry_queue: asyncio.Queue,
-        save_filepath: str,
+        retry_queue: RetryQueue,
+        writer: BackgroundWriter,
         status_tracker: StatusTracker,
+        headers_callback: Optional[Callable] = None,
     ):
-        """Does the async HTTP POST request to API and saves results."""
-        logging.info(f"Starting request #{self.task_id}")
-        logging.debug(f"metadata: {self.metadata}")
+        """Does the async HTTP POST request to API and saves results.
+
+        The session is shared by every request in a run so that keep-alive
+        connections (and their TLS handshakes) are reused. If given,
+        headers_callback is called with the response headers, e.g. to sync the
+        rate limiters with the server's view of the remaining quota. Successful
+        (2xx) responses are cached by the writer, if it has a response cache.
+        """
+        logger.info("Starting request #%d", self.task_id)
+        logger.debug("metadata: %s", self.metadata)
         error = None
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url=request_url, headers=request_header, json=self.request_json
-                ) as response:
-                    print("before: ", response)
-                    response = await response.json()
-                    print("after: ", response)
-            if "error" in response:
-                logging.warning(
-                    f"Request {self.task_id} failed with error {response['error']}"
+            # serialized here rather than by aiohttp, which uses the stdlib json
+            async with session.post(
+                url=request_url, data=json_dumps(self.request_json)
+            ) as response:
+                status = response.status
+                headers = response.headers
+                body = await response.read()
+            if headers_callback is not None:
+                headers_callback(headers)
+            # failures are told apart by status code before the body is
+            # trusted, so a 429 or 5xx without a JSON error object still counts
+            if status >= 400:
+                error = self._error_from_body(body, status)
+            else:
+                # orjson (when installed) parses the body, not aiohttp's stdlib json
+                response = json_loads(body)
+                logger.debug("Request %d response: %s", self.task_id, response)
+                if "error" in response:
+                    error = response
+            if error:
+                logger.warning(
+                    "Request %d failed with status %d: %s",
+                    self.task_id,
+                    status,
+                    error,
                 )
-
-                error = response
-                if "Rate limit" in response["error"].get("message", ""):
-                    status_tracker.had_rate_limit_error()
+                if status == 429:
+                    status_tracker.had_rate_limit_error(
+                        parse_retry_after(headers.get("retry-after"))
+                    )
                 else:
                     status_tracker.had_api_error()
 
-        except ValueError as e:  # catching naked exceptions is bad practice
-            logging.warning(f"Request {self.task_id} failed with Exception {e}")
+        # timeouts, connection errors and undecodable bodies are retried like
+        # any other failed attempt, so the request is always accounted for
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning("Request %d failed with Exception %s", self.task_id, e)
             status_tracker.num_other_errors += 1
             error = e
 
         # if you encounter an error which could not be processed, then save
         if error:
-            await self._failure(error, status_tracker, save_filepath, retry_queue)
+            await self._failure(error, status_tracker, writer, retry_queue)
         else:
-            await self._success(response, status_tracker, save_filepath)
+            # only real answers are cached, or later runs would replay errors
+            cache_key = None
+            if (
+                self.write_to_file
+                and writer.response_cache is not None
+                and 200 <= status < 300
+            ):
+                cache_key = request_cache_key(request_url, self.request_json)
+            await self._success(response, status_tracker, writer, cache_key)
+
+    @staticmethod
+    def _error_from_body(body: bytes, status: int):
+        """The decoded error body of a failed response, or its text if it isn't
+        JSON, or just the status if it is empty."""
+        try:
+            error = json_loads(body)
+        except ValueError:
+            error = body.decode("utf-8", errors="replace").strip()
+        return error or f"HTTP {status}"
 
-    async def _failure(self, error, status_tracker, save_filepath, retry_queue):
+    async def _failure(self, error, status_tracker, writer, retry_queue):
         """Handles a failed request. Retries if attempts remain, otherwise logs error."""
-        self.result.append(error)
+        # keep the message, not the exception, whose traceback pins whole frames
+        self.result.append(str(error))
         if self.attempts_left:
-            retry_queue.put_nowait(self)
+            backoff = RETRY_BACKOFF_SECONDS * 2 ** (len(self.result) - 1)
+            backoff += random.uniform(0, RETRY_JITTER_SECONDS)
+            retry_queue.put(self, delay=min(backoff, MAX_RETRY_BACKOFF_SECONDS))
         else:
-            logging.error(
-                f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
+            logger.error(
+                "Request %s failed after all attempts. Saving errors: %s",
+                self.request_json,
+                self.result,
             )
-            error_response = [str(e) for e in self.result]
-            data = [self.request_json, error_response]
-            data.append(self.metadata) if self.metadata else ""
-
+            data = (self.request_json, self.result, self.metadata)
             if self.write_to_file:
-                append_to_jsonl(data, save_filepath)
+                writer.write(data)
             status_tracker.task_failed()
 
-    async def _success(self, response, status_tracker, save_filepath):
-        """Handles a successful request. Saves results to file."""
-        data = [self.request_json, response]
-        data.append(self.metadata) if self.metadata else ""
-
-        print(data)
+    async def _success(self, response, status_tracker, writer, cache_key=None):
+        """Handles a successful request. Saves results to file, and caches the
+        response under cache_key if given."""
+        data = (self.request_json, response, self.metadata)
         if self.write_to_file:
-            append_to_jsonl(data, save_filepath)
+            writer.write(data, cache_key)
+            logger.debug("Request %d saved to %s", self.task_id, writer.filename)
         status_tracker.task_succeeded()
-        logging.debug(f"Request {self.task_id} saved to {save_filepath}")
 
 
 class APIRequestProcessor:
@@ -182,8 +394,9 @@ class APIRequestProcessor:
 
     Args:
         save_filepath (str, optional): path to the file where the results will be saved
-            - file will be a jsonl file, where each line is an array with the original request plus the API response
-            - e.g., [{"model": "text-embedding-ada-002", "input": "embed me"}, {...}]
+            - file will be a jsonl file, where each line is an array of the original request, the API response (or the list of errors, if it failed) and the request's metadata
+            - e.g., [{"model": "text-embedding-ada-002", "input": "embed me"}, {...}, null]
+            - the metadata is null when the request had none
             - if omitted, results will be saved to {requests_filename}_results.jsonl
 
         request_url (str, optional): URL of the API endpoint to call
@@ -217,8 +430,22 @@ class APIRequestProcessor:
         rate_limit_pause (int, optional): seconds to pause after rate limit error.
             - Default is 15 seconds.
 
-        seconds_to_sleep_each_loop: Optional[float]: seconds to sleep each loop.
-            - Default is 1 ms which limits max throughput to 1,000 requests per second
+        loop_sleep_seconds (float, optional): shortest wait for the rate limit buckets to refill.
+            - the loop otherwise sleeps until a request is read, a call finishes or a retry is due
+            - Default is 1 ms
+
+        max_inflight (int, optional): maximum number of requests awaiting a response at once
+            - bounds open connections and pending tasks when the rate limits allow large bursts
+            - Default is None: five seconds' worth of requests at max_requests_per_minute, at least 64
+
+        use_cache (bool, optional): cache successful responses on disk, keyed by a hash of the request
+            - requests found in the cache are written to the results without calling the API
+            - the cache lives next to the results at {save_filepath}.cache, so re-runs reuse it
+            - Default is False
+
+        request_timeout (float, optional): seconds before a request is abandoned and retried
+            - covers connecting, sending and reading the whole response
+            - Default is 60 seconds
     """
 
     def __init__(
@@ -234,20 +461,22 @@ class APIRequestProcessor:
         logging_level: Optional[int] = 20,
         rate_limit_pause: int = 15,
         loop_sleep_seconds: float = 0.001,
+        max_inflight: Optional[int] = None,
+        use_cache: bool = False,
+        request_timeout: float = 60,
     ) -> None:
-
         if api_key is None:
             self.api_key = os.environ["OPENAI_API_KEY"]
         else:
             self.api_key = api_key
 
-        self.save_filepath = save_filepath
-
-        if Path(self.save_filepath).exists():
-            self.save_filepath = nonduplicate_filename(self.save_filepath)
+        # keyed on the requested path, before any de-duplication, so re-runs share it
+        self.use_cache = use_cache
+        self.cache_filepath = f"{save_filepath}.cache"
 
-        if not Path(self.save_filepath).parent.exists():
-            Path(self.save_filepath).parent.mkdir(parents=True, exist_ok=True)
+        # never overwrite earlier results: foo.jsonl -> foo_1.jsonl if it exists
+        self.save_filepath = nonduplicate_filename(save_filepath)
+        Path(self.save_filepath).parent.mkdir(parents=True, exist_ok=True)
 
         self.request_url = request_url
 
@@ -256,33 +485,44 @@ class APIRequestProcessor:
 
         self.token_encoding_name = token_encoding_name
         self.max_attempts = max_attempts
+        if max_inflight is None:
+            max_inflight = max(64, int(max_requests_per_minute / 60 * 5))
+        self.max_inflight = max_inflight
+        self.request_timeout = request_timeout
         self.logging_level = logging_level
 
         # constants
         self.rate_limit_pause = rate_limit_pause
         self.loop_sleep_seconds = loop_sleep_seconds
+        self._cooldown_logged_for = None  # rate limit error the cooldown was logged for
 
-        # initialize logging
-        logging.basicConfig(
-            level=self.logging_level,
-            format="%(asctime)s  - %(levelname)s - %(message)s",
-        )
-        logging.debug(f"Logging initialized at level {self.logging_level}")
+        # the root logger is configured by the application (see cli), not here
+        logger.setLevel(self.logging_level)
+        logger.debug("Logging initialized at level %s", self.logging_level)
 
-        print("API:", which_api)
+        logger.debug("API: %s", which_api)
         # infer API endpoint and construct request header
         if which_api == "openai":
             self.api_endpoint = openai_api_endpoint_from_url(self.request_url)
-            self.request_header = {"Authorization": f"Bearer {self.api_key}"}
-            self.tokens_consumed = openai_num_tokens_consumed_from_request
+            self.request_header = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            }
+            # resolved once here, so counting a request needs no endpoint lookup
+            self.tokens_consumed = openai_token_counter(
+                self.api_endpoint, self.token_encoding_name
+            )
         elif which_api == "dummy":
             self.api_endpoint = "dummy"
             self.request_header = {"Content-Type": "application/json"}
-            self.tokens_consumed = lambda x, y, z: 0
+            self.tokens_consumed = lambda request_json: 0
         elif which_api == "huggingface":
             self.api_endpoint = "huggingface"
-            self.request_header = {"Authorization": f"Bearer {self.api_key}"}
-            self.tokens_consumed = lambda x, y, z: 0
+            self.request_header = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            }
+            self.tokens_consumed = lambda request_json: 0
         else:
             raise ValueError(f"API {which_api} not supported.")
 
@@ -310,138 +550,382 @@ class APIRequestProcessor:
         # single instance to track a collection of variables
         status_tracker = StatusTracker()
 
-        # `requests` will provide requests one at a time
-        print(requests_file)
-        with open(requests_file, "r") as file:
-            requests = iter(file.readlines())
-
-        logging.debug(f"File:{requests_file} opened. Entering main loop")
-        asyncio.run(
-            self._process_api_requests_from_file(
-                requests,
-                task_id_generator,
-                status_tracker,
+        # `requests` streams decoded requests from the file one at a time
+        logger.debug("Reading requests from %s", requests_file)
+        requests = iter_jsonl(requests_file)
+
+        response_cache = ResponseCache(self.cache_filepath) if self.use_cache else None
+
+        logger.debug("File:%s opened. Entering main loop", requests_file)
+        # uvloop's libuv-based loop, when installed, speeds up the socket I/O
+        run_event_loop = uvloop_run if uvloop_run is not None else asyncio.run
+        try:
+            run_event_loop(
+                self._process_api_requests_from_file(
+                    requests,
+                    task_id_generator,
+                    status_tracker,
+                    response_cache,
+                )
             )
-        )
+        finally:
+            if response_cache is not None:
+                response_cache.close()
 
     async def _process_api_requests_from_file(
         self,
         requests,
         task_id_generator,
         status_tracker,
+        response_cache=None,
     ) -> None:
         """Main async loop to process API requests"""
 
+        logger.debug("Initialization complete.")
+
+        # one session for the whole run, so connections are pooled and reused;
+        # one connection per in-flight slot, so no request waits for a socket
+        connector = aiohttp.TCPConnector(
+            limit=self.max_inflight, ttl_dns_cache=300, keepalive_timeout=75
+        )
+        # claim the results file atomically: if another run has taken the name
+        # picked in __init__ since, move on to the next free suffix rather than
+        # interleaving our rows with theirs
+        self.save_filepath = nonduplicate_filename(self.save_filepath, create=True)
+        # one buffered handle for the results, flushed and closed before renaming;
+        # rows reach it through a background task, off the event loop
+        with JsonlWriter(self.save_filepath) as file_writer:
+            async with BackgroundWriter(file_writer, response_cache) as writer:
+                async with aiohttp.ClientSession(
+                    connector=connector,
+                    headers=self.request_header,
+                    timeout=aiohttp.ClientTimeout(
+                        total=self.request_timeout, sock_connect=10
+                    ),
+                ) as session:
+                    await self._dispatch_requests(
+                        session,
+                        writer,
+                        requests,
+                        task_id_generator,
+                        status_tracker,
+                        response_cache,
+                    )
+
+        await self._after_finishing(status_tracker)
+
+    async def _dispatch_requests(
+        self,
+        session: aiohttp.ClientSession,
+        writer: BackgroundWriter,
+        requests,
+        task_id_generator,
+        status_tracker: StatusTracker,
+        response_cache=None,
+    ) -> None:
+        """Call the API for every request as capacity allows, until all are done."""
+
         # initialize trackers
-        requests_retry_queue = asyncio.Queue()
+        requests_retry_queue = RetryQueue()
+        # set whenever the loop may have new work: a request read or a call finished
+        wakeup = asyncio.Event()
+        # (request, token count) pairs read ahead of dispatch; None marks the end
+        request_queue: asyncio.Queue = asyncio.Queue(maxsize=READ_QUEUE_SIZE)
+        reader = asyncio.create_task(
+            self._read_requests(requests, request_queue, wakeup, response_cache)
+        )
+        # a slot is held by each request from dispatch until its response is handled
+        inflight_slots = asyncio.Semaphore(self.max_inflight)
+        # the event loop only keeps weak references to tasks, so the calls in
+        # flight are held here; a call that crashed is kept to re-raise its error
+        inflight_calls: set = set()
+        crashed_calls: list = []
+
+        def call_done(task: asyncio.Task) -> None:
+            inflight_calls.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                crashed_calls.append(task)
+                wakeup.set()
 
         next_request = None  # variable to hold the next request to call
 
-        # initialize available capacity counts
-        self.token_limiter.start_timer()
-        self.request_limiter.start_timer()
+        # bound once, as the loop below reads them for every request
+        request_limiter = self.request_limiter
+        token_limiter = self.token_limiter
+        max_attempts = self.max_attempts
+        request_url = self.request_url
+        headers_callback = self._apply_rate_limit_headers
+        next_task_id = task_id_generator.__next__
 
         # initialize flags
         file_not_finished = True  # after file is empty, we'll skip reading it
-        logging.debug(f"Initialization complete.")
+        burst = 0  # requests handled since the loop last yielded
 
         while True:
+            wakeup.clear()
+            made_progress = False  # a request was taken, dispatched or answered
+            if crashed_calls:
+                # an error call_api doesn't handle would leave its request in
+                # progress forever, so stop the run rather than wait for it
+                crashed_calls[0].result()
+
             # get next request (if one is not already waiting for capacity)
             if next_request is None:
-                if not requests_retry_queue.empty():
-                    next_request = requests_retry_queue.get_nowait()
-                    logging.debug(
-                        f"Retrying request {next_request.task_id}: {next_request}"
+                next_request = requests_retry_queue.pop_due()
+                if next_request is not None:
+                    logger.debug(
+                        "Retrying request %d: %s", next_request.task_id, next_request
                     )
-                elif file_not_finished:
-                    try:
-                        # get new request
-                        request_json = json.loads(next(requests))
-                        print(request_json)
+                elif file_not_finished and not request_queue.empty():
+                    queued = request_queue.get_nowait()
+                    made_progress = True
+                    if queued is None:
+                        # if file runs out, set flag to stop reading it
+                        logger.debug("Read file exhausted")
+                        file_not_finished = False
+                    else:
+                        (
+                            request_json,
+                            metadata,
+                            token_consumption,
+                            cached_response,
+                        ) = queued
                         next_request = APIRequest(
-                            task_id=next(task_id_generator),
+                            task_id=next_task_id(),
                             request_json=request_json,
-                            token_consumption=self.tokens_consumed(
-                                request_json,
-                                self.api_endpoint,
-                                self.token_encoding_name,
-                            ),
-                            attempts_left=self.max_attempts,
-                            metadata=request_json.pop("metadata", None),
+                            token_consumption=token_consumption,
+                            attempts_left=max_attempts,
+                            metadata=metadata,
                         )
                         status_tracker.task_started()
-                        logging.debug(
-                            f"Reading request {next_request.task_id}: {next_request}"
+                        logger.debug(
+                            "Reading request %d: %s", next_request.task_id, next_request
                         )
-                    except StopIteration:
-                        # if file runs out, set flag to stop reading it
-                        logging.debug("Read file exhausted")
-                        file_not_finished = False
-
-            self.request_limiter.update_allowance()
-            self.token_limiter.update_allowance()
-            # if enough capacity available, call API
-            if next_request:
+                        if cached_response is not None:
+                            # answered by a previous run, skip the API call
+                            await next_request._success(
+                                cached_response,
+                                status_tracker,
+                                writer,
+                            )
+                            next_request = None
+                elif file_not_finished and reader.done():
+                    reader.result()  # the reader stopped early: raise its error
+
+            # if a slot is free and enough capacity available in both buckets, call API
+            capacity_wait = 0.0
+            if next_request and not inflight_slots.locked():
                 next_request_tokens = next_request.token_consumption
-                if (
-                    self.request_limiter.current_capacity >= 1
-                    and self.token_limiter.current_capacity >= next_request_tokens
-                ):
+                now = time.monotonic()  # one clock read for all three checks
+                # during a rate limit cooldown only new dispatches wait; calls
+                # in flight, reads and cached answers carry on meanwhile
+                capacity_wait = max(
+                    self._cooldown_remaining(status_tracker, now),
+                    request_limiter.wait_time(1, now),
+                    token_limiter.wait_time(next_request_tokens, now),
+                )
+                if capacity_wait == 0:
                     # update counters
-                    self.request_limiter.current_capacity -= 1
-                    self.token_limiter.current_capacity -= next_request_tokens
+                    request_limiter.update_usage(1)
+                    token_limiter.update_usage(next_request_tokens)
                     next_request.attempts_left -= 1
 
                     # call API
-                    asyncio.create_task(
-                        next_request.call_api(
-                            request_url=self.request_url,
-                            request_header=self.request_header,
-                            retry_queue=requests_retry_queue,
-                            save_filepath=self.save_filepath,
-                            status_tracker=status_tracker,
+                    await inflight_slots.acquire()
+                    call = asyncio.create_task(
+                        self._release_after(
+                            inflight_slots,
+                            wakeup,
+                            next_request.call_api(
+                                session=session,
+                                request_url=request_url,
+                                retry_queue=requests_retry_queue,
+                                writer=writer,
+                                status_tracker=status_tracker,
+                                headers_callback=headers_callback,
+                            ),
                         )
                     )
+                    inflight_calls.add(call)
+                    call.add_done_callback(call_done)
                     next_request = None  # reset next_request to empty
+                    made_progress = True
 
-            # if all tasks are finished, break
-            if status_tracker.num_tasks_in_progress == 0:
+            # if the file is read and all tasks are finished, break
+            if not file_not_finished and status_tracker.num_tasks_in_progress == 0:
                 break
 
-            # main loop sleeps briefly so concurrent tasks can run
-            await asyncio.sleep(self.loop_sleep_seconds)
+            if made_progress:
+                burst += 1
+                if burst < DISPATCH_BURST_SIZE:
+                    continue  # take the next request straight away
+                await asyncio.sleep(0)  # let the calls start, then carry on
+            else:
+                # nothing to do until the buckets have refilled enough for the
+                # waiting request, a retry is due, or a read or call wakes us
+                if capacity_wait > 0:
+                    timeout = max(self.loop_sleep_seconds, capacity_wait)
+                elif next_request is not None:
+                    # waiting for an in-flight slot, which wakes us when freed;
+                    # retries are only taken once the waiting request is sent
+                    timeout = None
+                else:
+                    timeout = requests_retry_queue.seconds_until_due()
+                await self._wait_for_wakeup(wakeup, timeout)
+            burst = 0
 
-            await self._rate_limit_cooldown(status_tracker)
+    async def _read_requests(
+        self,
+        requests,
+        request_queue: asyncio.Queue,
+        wakeup: asyncio.Event,
+        response_cache: Optional[ResponseCache] = None,
+    ) -> None:
+        """Feed (request, metadata, token count, cached response) tuples into
+        the queue, then None at the end.
 
-        await self._after_finishing(status_tracker)
+        File reads, JSON decoding, token counting and cache lookups run in a
+        worker thread, so they overlap with the network I/O on the event loop
+        instead of stalling it. tiktoken releases the GIL while encoding, so the
+        two truly overlap.
+        """
+        try:
+            while True:
+                batch = await asyncio.to_thread(
+                    self._read_batch, requests, response_cache
+                )
+                for queued in batch:
+                    await request_queue.put(queued)
+                    wakeup.set()
+                if len(batch) < READ_BATCH_SIZE:
+                    break
+            await request_queue.put(None)
+        finally:
+            wakeup.set()  # also on error, so the loop can raise it
+
+    def _read_batch(
+        self, requests, response_cache: Optional[ResponseCache] = None
+    ) -> list:
+        """Read up to READ_BATCH_SIZE requests, count the tokens of each and
+        look up any answer a previous run cached for it."""
+        tokens_consumed = self.tokens_consumed
+        request_url = self.request_url
+        batch = []
+        for request_json in itertools.islice(requests, READ_BATCH_SIZE):
+            token_consumption = tokens_consumed(request_json)
+            metadata = request_json.pop("metadata", None)
+            cached_response = None
+            if response_cache is not None:
+                cache_key = request_cache_key(request_url, request_json)
+                cached_response = response_cache.get(cache_key)
+            batch.append((request_json, metadata, token_consumption, cached_response))
+        return batch
+
+    @staticmethod
+    async def _release_after(
+        slot: asyncio.Semaphore, wakeup: asyncio.Event, call
+    ) -> None:
+        """Await an API call, then free its in-flight slot whatever the outcome."""
+        try:
+            await call
+        finally:
+            slot.release()
+            wakeup.set()
+
+    @staticmethod
+    async def _wait_for_wakeup(wakeup: asyncio.Event, timeout: Optional[float]) -> None:
+        """Wait until the event is set, or for at most timeout seconds if given."""
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _apply_rate_limit_headers(self, headers) -> None:
+        """Clamp the local rate limiters to the quota the server reports as left.
+
+        OpenAI sends x-ratelimit-remaining-* and x-ratelimit-reset-* headers on
+        every response; other APIs simply don't, and are left untouched.
+        """
+        for limiter, kind in (
+            (self.request_limiter, "requests"),
+            (self.token_limiter, "tokens"),
+        ):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            try:
+                limiter.sync_remaining(
+                    float(remaining),
+                    parse_reset_duration(reset) if reset is not None else None,
+                )
+            except ValueError:
+                logger.debug("Ignoring malformed rate limit headers for %s", kind)
+
+    def _cooldown_remaining(
+        self, status_tracker: StatusTracker, now: Optional[float] = None
+    ) -> float:
+        """Seconds left to cool down after the last rate limit error, or 0.
 
-    async def _rate_limit_cooldown(self, status_tracker: StatusTracker):
-        # if a rate limit error was hit recently, pause to cool down
-        seconds_since_error = time.time() - status_tracker.last_rate_error_time
-        if seconds_since_error < self.rate_limit_pause:
-            time_until_resume = self.rate_limit_pause - seconds_since_error
-            await asyncio.sleep(time_until_resume)
-            # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-            logging.warn(
-                f"Pausing to cool down until {time.ctime(status_tracker.last_rate_error_time + self.rate_limit_pause)}"
+        The pause lasts as long as the server asked (Retry-After), or
+        rate_limit_pause otherwise.
+        """
+        if not status_tracker.num_rate_limit_errors:
+            return 0.0  # last_rate_error_time is unset, not a moment after boot
+        pause = status_tracker.retry_after
+        if pause is None:
+            pause = self.rate_limit_pause
+        if now is None:
+            now = time.monotonic()
+        seconds_since_error = now - status_tracker.last_rate_error_time
+        if seconds_since_error >= pause:
+            return 0.0
+        time_until_resume = pause - seconds_since_error
+        # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
+        if self._cooldown_logged_for != status_tracker.last_rate_error_time:
+            self._cooldown_logged_for = status_tracker.last_rate_error_time
+            logger.warning(
+                "Pausing to cool down until %s",
+                time.ctime(time.time() + time_until_resume),  # wall clock
             )
+        return time_until_resume
+
+    @staticmethod
+    def _move_to_unused_name(path: Path, target: Path) -> str:
+        """Move path to target, or to target with a suffix if that is taken.
+
+        The new name is claimed atomically before the move, so the results of
+        an earlier run that failed too are never overwritten.
+        """
+        claimed = nonduplicate_filename(str(target), create=True)
+        path.replace(claimed)
+        return claimed
 
     async def _after_finishing(self, status_tracker: StatusTracker):
-        # after finishing, log final status
-        logging.info(
-            f"Parallel processing complete. Result saved to: {self.save_filepath}"
-        )
+        # rename file if tasks failed, e.g. results.jsonl -> results_with_errors.jsonl
         if status_tracker.num_tasks_failed > 0:
-            logging.warning(
-                f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {self.save_filepath}."
+            save_path = Path(self.save_filepath)
+            errors_path = save_path.with_name(
+                f"{save_path.stem}_with_errors{save_path.suffix}"
             )
-        if status_tracker.num_rate_limit_errors > 0:
-            logging.warning(
-                f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
+            # off the event loop, as a rename can block on slow or network filesystems
+            self.save_filepath = await asyncio.to_thread(
+                self._move_to_unused_name, save_path, errors_path
             )
-        # rename file if tasks failed
+
+        # after finishing, log final status
+        logger.info(
+            "Parallel processing complete. Result saved to: %s", self.save_filepath
+        )
         if status_tracker.num_tasks_failed > 0:
-            os.rename(
+            logger.warning(
+                "%d / %d requests failed. Errors logged to %s.",
+                status_tracker.num_tasks_failed,
+                status_tracker.num_tasks_started,
                 self.save_filepath,
-                self.save_filepath.replace(".jsonl", "_with_errors.jsonl"),
+            )
+        if status_tracker.num_rate_limit_errors > 0:
+            logger.warning(
+                "%d rate limit errors received. Consider running at a lower rate.",
+                status_tracker.num_rate_limit_errors,
             )
@@ -1,36 +1,68 @@
-"""Beginning of refactor of rate limiter to be more generic and reusable."""
+"""Token bucket rate limiter shared by the request and token limits."""
 
 import time
+from typing import Optional
 
 
 class RateLimiter:
     """Implements a token bucket for handling rate limits
 
+    The bucket holds at most ``limit`` units and refills continuously at
+    ``limit / period`` units per second, so bursts up to the full limit are
+    allowed while the average rate over any ``period`` stays under ``limit``.
+    Refills are computed lazily from a monotonic clock whenever the bucket is
+    inspected.
+
     Args:
             limit (int): Maximum rate allowed of over the time period
             period (int): The time in seconds over which the rate limit applies
     """
 
     def __init__(self, limit: float, period: float):
-
         self.limit = limit
         self.period = period
+        self.rate = limit / period  # units refilled per second
 
         self.current_capacity = limit
-        self._last_update_time = time.time()
+        self._last_update_time = time.monotonic()
 
-    def start_timer(self):
-        self.start_time = time.time()
+    def update_allowance(self, now: Optional[float] = None):
+        """Refill the bucket for the time passed since the last update.
 
-    def update_allowance(self):
-        update_time = time.time()
+        ``now`` is a time.monotonic() reading, so callers checking several
+        limiters at once can share one clock read.
+        """
+        update_time = time.monotonic() if now is None else now
         time_passed = update_time - self._last_update_time
-        self.current_capacity += time_passed * (self.limit / self.period)
+        self._last_update_time = update_time
+        self.current_capacity += time_passed * self.rate
         if self.current_capacity > self.limit:
             self.current_capacity = self.limit  # throttle
 
-    def has_limited(self, attempted_usage) -> bool:
-        return self.current_capacity > attempted_usage
+    def wait_time(self, amount: float, now: Optional[float] = None) -> float:
+        """Seconds until ``amount`` units are available, 0 if they are available now.
+
+        An amount larger than the whole bucket only waits for a full bucket,
+        otherwise it could never be sent.
+        """
+        self.update_allowance(now)
+        amount = min(amount, self.limit)
+        if self.current_capacity >= amount:
+            return 0.0
+        return (amount - self.current_capacity) / self.rate
+
+    def sync_remaining(self, remaining: float, reset_seconds: Optional[float] = None):
+        """Clamp the bucket to the capacity the server reports as remaining.
+
+        If the server says the quota is exhausted, the bucket is held so that
+        the next unit only becomes available once the server's window resets.
+        """
+        self.update_allowance()
+        self.current_capacity = min(self.current_capacity, remaining)
+        if remaining < 1 and reset_seconds is not None:
+            self.current_capacity = min(
+                self.current_capacity, 1 - reset_seconds * self.rate
+            )
 
     def update_usage(self, usage):
         self.current_capacity -= usage
@@ -1,43 +1,187 @@
 """ Contains utils for the main parareq module.
 
     - Define functions
-        - api_endpoint_from_url (extracts API endpoint from request URL)
+        - json_dumps (serializes a request body)
+        - json_loads (parses json, with orjson when installed)
+        - dumps_jsonl_line (serializes one line of a jsonl file)
         - append_to_jsonl (writes to results file)
-        - num_tokens_consumed_from_request (bigger function to infer token usage from request)
-        - task_id_generator_function (yields 1, 2, 3, ...)
+        - append_many_to_jsonl (writes several results in one go)
+        - JsonlWriter (keeps the results file open and batches writes)
+        - iter_jsonl (streams requests from a jsonl file)
+        - parse_retry_after (reads a Retry-After header)
+        - request_cache_key (hashes a request for the response cache)
+        - create_task_id_generator (counts 0, 1, 2, ...)
+        - nonduplicate_filename (finds, and optionally claims, an unused file name)
+        - create_requests_file (writes a jsonl file of requests)
 """
 
+import hashlib
+import itertools
 import json
-from pathlib import Path
+import os
+from typing import Iterable, Iterator, Optional
+
+try:  # orjson is optional, stdlib json is used as a fallback
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+# make the stdlib json fallback match orjson: compact, utf-8 rather than \u escapes
+JSON_FALLBACK_OPTIONS = {"separators": (",", ":"), "ensure_ascii": False}
+
+# size of the chunks create_requests_file hands to write()
+WRITE_CHUNK_SIZE = 1 << 16
+
+
+def json_dumps(data) -> bytes:
+    """Serialize data to compact json bytes, e.g. for a request body."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, **JSON_FALLBACK_OPTIONS).encode()
+
+
+def dumps_jsonl_line(data) -> bytes:
+    """Serialize data to a single newline terminated jsonl line."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(data, **JSON_FALLBACK_OPTIONS) + "\n").encode()
 
 
 def append_to_jsonl(data, filename: str) -> None:
     """Append a json payload to the end of a jsonl file."""
-    json_string = json.dumps(data)
-    with open(filename, "a") as f:
-        f.write(json_string + "\n")
+    append_many_to_jsonl([data], filename)
 
 
-def create_task_id_generator():
-    """Generate integers 0, 1, 2, and so on."""
-    task_id = 0
-    while True:
-        yield task_id
-        task_id += 1
-
-
-def nonduplicate_filename(file_path: str) -> str:
-    """Ensure that the file path is unique by adding a suffix if necessary."""
-    path = Path(file_path)
-    if not path.exists():
-        return file_path
-    else:
-        i = 1
+def append_many_to_jsonl(records: Iterable, filename: str) -> None:
+    """Append json payloads to the end of a jsonl file, one per line.
+
+    The lines go out through an O_APPEND descriptor with os.write, skipping
+    Python's file object layers. A payload the kernel takes in a single write
+    lands whole at the end of the file; if it needs several writes, lines from
+    concurrent appenders may interleave with it.
+    """
+    payload = b"".join(map(dumps_jsonl_line, records))
+    if not payload:
+        return
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        view = memoryview(payload)
+        while view:  # os.write may write less than it was given
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+class JsonlWriter:
+    """Appends json lines to a file through one long-lived buffered handle.
+
+    Unlike append_to_jsonl, the file is opened once. Serialized lines are
+    handed to writelines in batches of batch_size, and the file is flushed and
+    fsynced when closed.
+    """
+
+    def __init__(self, filename: str, batch_size: int = 64, buffer_size: int = 1 << 20):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._file = open(filename, "ab", buffering=buffer_size)
+        self._pending = []
+
+    def write(self, data) -> None:
+        self._pending.append(dumps_jsonl_line(data))
+        if len(self._pending) >= self.batch_size:
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        self._file.writelines(self._pending)
+        self._pending.clear()
+
+    def flush(self) -> None:
+        self._write_pending()
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_jsonl(file_path: str, chunk_size: int = 1 << 20):
+    """Yield the decoded json object on each line of a jsonl file.
+
+    The file is read as raw bytes in large chunks and split on newlines, which
+    avoids the per-line readline and str decoding cost. Blank lines are skipped.
+    """
+    with open(file_path, "rb") as f:
+        tail = b""
         while True:
-            new_path = path.with_name(f"{path.stem}_{i}{path.suffix}")
-            if not new_path.exists():
-                return str(new_path)
-            i += 1
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json_loads(line)
+        if tail.strip():
+            yield json_loads(tail)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Read a Retry-After header given in seconds; None if missing or not a number."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def request_cache_key(request_url: str, request_json: dict) -> str:
+    """Hash the URL and canonical json of a request, so equal requests to the
+    same endpoint share a key and other endpoints' answers are never reused."""
+    canonical = json.dumps(
+        [request_url, request_json], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def create_task_id_generator() -> Iterator[int]:
+    """Generate integers 0, 1, 2, and so on."""
+    return itertools.count()
+
+
+def nonduplicate_filename(file_path: str, create: bool = False) -> str:
+    """Ensure that the file path is unique by adding a suffix if necessary.
+
+    With create=True the returned name is also claimed: the empty file is
+    created atomically (O_CREAT | O_EXCL), so no other process can take the
+    same name between the check and the first write.
+    """
+    root, ext = os.path.splitext(file_path)
+    candidates = itertools.chain(
+        [file_path], (f"{root}_{i}{ext}" for i in itertools.count(1))
+    )
+    for candidate in candidates:
+        if not create:
+            if not os.path.exists(candidate):
+                return candidate
+            continue
+        try:
+            fd = os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return candidate
 
 
 def create_requests_file(
@@ -50,13 +194,22 @@ def create_requests_file(
     """
 
     n_requests = 10_000
-    jobs = [
-        {"model": "text-embedding-ada-002", "input": str(x) + "\n"}
-        for x in range(n_requests)
-    ]
-    # check
-
-    with open(file_path, "w") as f:
-        for job in jobs:
-            json_string = json.dumps(job)
-            f.write(json_string + "\n")
+    # every job is {"model": "text-embedding-ada-002", "input": f"{x}\n"}: only
+    # the number varies and digits need no escaping, so each line is assembled
+    # from the constant json around it rather than serialized from a dict
+    prefix = b'{"model":"text-embedding-ada-002","input":"'
+    suffix = b'\\n"}\n'
+
+    # lines are written in 64 KiB chunks, so the whole file is never held in memory
+    with open(file_path, "wb") as f:
+        buffer = bytearray()
+        for x in range(n_requests):
+            # appended piece by piece, so no intermediate bytes are built
+            buffer += prefix
+            buffer += str(x).encode()
+            buffer += suffix
+            if len(buffer) >= WRITE_CHUNK_SIZE:
+                f.write(buffer)
+                buffer.clear()
+        if buffer:
+            f.write(buffer)
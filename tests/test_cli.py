@@ -2,6 +2,8 @@ import os
 from pathlib import Path
 import pytest
 
+from parareq.cli import _build_parser, _default_save_filepath, look_for_api_key
+
 
 def test_cli_entrypoint_help():
     exit_status = os.system("parareq --help")
@@ -35,3 +37,26 @@ def test_cli_entrypoint_dry_run_no_request_conf():
         "parareq --dry_run --save_filepath output_example.jsonl --requests_filepath doesnt/exist/config_example.jsonl"
     )
     assert exit_status != 0
+
+
+def test_cli_boolean_flags_parse_explicitly():
+    parser = _build_parser()
+    assert parser.parse_args([]).create_requests_file is False
+    assert parser.parse_args(["--create_requests_file"]).create_requests_file
+    args = parser.parse_args(["--no-create_requests_file", "--no-dry_run"])
+    assert args.create_requests_file is False
+    assert args.dry_run is False
+
+
+def test_look_for_api_key_reads_environment(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setenv("HF_API_KEY", "hf-key")
+    args = _build_parser().parse_args(["--which_api", "huggingface"])
+    look_for_api_key(args)
+    assert args.api_key == "hf-key"
+
+
+def test_default_save_filepath_only_renames_the_file():
+    assert _default_save_filepath("data/2024.jsonl.archive/foo.jsonl") == str(
+        Path("data/2024.jsonl.archive/foo_results.jsonl")
+    )
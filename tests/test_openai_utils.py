@@ -1,10 +1,159 @@
+import pytest
+
 from parareq.openai_utils import (
+    count_completion_tokens,
+    count_embedding_tokens,
     openai_api_endpoint_from_url,
+    openai_token_counter,
+    parse_reset_duration,
 )
 
 
+class WhitespaceEncoding:
+    """Stand-in for a tiktoken encoding where every word is one token."""
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        return [self.encode_ordinary(text) for text in texts]
+
+
 def test_openai_api_endpoint_from_url():
     """Test the function that extracts the API endpoint from the request URL."""
     request_url = "https://api.openai.com/v1/embeddings"
     endpoint = openai_api_endpoint_from_url(request_url)
     assert endpoint == "embeddings"
+
+
+def test_openai_api_endpoint_from_url_rejects_unversioned_url():
+    with pytest.raises(ValueError):
+        openai_api_endpoint_from_url("https://api.openai.com/embeddings")
+
+
+def test_encoding_is_loaded_once_per_name(monkeypatch):
+    """The tiktoken encoding should be built once, not once per request."""
+    import tiktoken
+
+    import parareq.openai_utils as openai_utils
+
+    loads = []
+    monkeypatch.setattr(
+        tiktoken, "get_encoding", lambda name: loads.append(name) or name
+    )
+    openai_utils._get_encoding.cache_clear()
+    try:
+        for _ in range(3):
+            assert openai_utils._get_encoding("fake_base") == "fake_base"
+        assert loads == ["fake_base"]
+    finally:
+        openai_utils._get_encoding.cache_clear()
+
+
+def test_count_embedding_tokens_single_and_batched_inputs():
+    encoding = WhitespaceEncoding()
+    single = {"input": "embed these three"}
+    batch = {"input": ["embed me", "and me too", "long " * 20]}
+    assert count_embedding_tokens(encoding, single, "embeddings") == 3
+    assert count_embedding_tokens(encoding, batch, "embeddings") == 25
+
+
+def test_only_large_input_lists_are_batch_encoded():
+    class BatchCountingEncoding(WhitespaceEncoding):
+        def __init__(self):
+            self.batches = 0
+
+        def encode_ordinary_batch(self, texts, num_threads=8):
+            self.batches += 1
+            return super().encode_ordinary_batch(texts, num_threads)
+
+    encoding = BatchCountingEncoding()
+    small = {"input": ["long " * 20, "longer " * 30]}
+    assert count_embedding_tokens(encoding, small, "embeddings") == 50
+    assert encoding.batches == 0
+
+    large = {"input": ["word " * 10_000, "word " * 10_000]}
+    assert count_embedding_tokens(encoding, large, "embeddings") == 20_000
+    assert encoding.batches == 1
+
+
+def test_count_completion_tokens_prompt_list():
+    encoding = WhitespaceEncoding()
+    request = {"prompt": ["one two", "three"], "max_tokens": 10, "n": 2}
+    # prompt tokens + n * max_tokens per prompt
+    assert count_completion_tokens(encoding, request, "completions") == 3 + 2 * 20
+
+
+def test_count_completion_tokens_chat_messages():
+    encoding = WhitespaceEncoding()
+    request = {
+        "messages": [
+            {"role": "system", "content": "be brief"},
+            {"role": "user", "name": "bob", "content": "hello there"},
+        ],
+        "max_tokens": 5,
+    }
+    # 4 per message + 7 words - 1 for the named message + 2 priming + max_tokens
+    assert count_completion_tokens(encoding, request, "chat/completions") == 21
+
+
+def test_count_completion_tokens_chat_message_without_content():
+    encoding = WhitespaceEncoding()
+    request = {
+        "messages": [{"role": "assistant", "content": None, "tool_calls": []}],
+        "max_tokens": 5,
+    }
+    # 4 for the message + 1 for the role + 2 priming + max_tokens
+    assert count_completion_tokens(encoding, request, "chat/completions") == 12
+
+
+def test_count_completion_tokens_memoizes_repeated_messages():
+    class CountingEncoding(WhitespaceEncoding):
+        def __init__(self):
+            self.calls = []
+
+        def encode_ordinary(self, text):
+            self.calls.append(text)
+            return super().encode_ordinary(text)
+
+    encoding = CountingEncoding()
+    system = {"role": "system", "content": "a long shared system prompt"}
+    for question in ("first question", "second question"):
+        request = {"messages": [system, {"role": "user", "content": question}]}
+        count_completion_tokens(encoding, request, "chat/completions")
+    assert encoding.calls.count("a long shared system prompt") == 1
+    assert encoding.calls.count("system") == 1
+
+    # a long document is encoded on each request rather than cached
+    document = "word " * 1000
+    for _ in range(2):
+        request = {"messages": [system, {"role": "user", "content": document}]}
+        count_completion_tokens(encoding, request, "chat/completions")
+    assert encoding.calls.count(document) == 2
+
+
+@pytest.mark.parametrize(
+    "duration, seconds",
+    [("6s", 6.0), ("1m30s", 90.0), ("20ms", 0.02), ("1h2m0.5s", 3720.5)],
+)
+def test_parse_reset_duration(duration, seconds):
+    assert parse_reset_duration(duration) == pytest.approx(seconds)
+
+
+def test_parse_reset_duration_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_reset_duration("soon")
+
+
+def test_openai_token_counter_resolves_endpoint_once(monkeypatch):
+    import parareq.openai_utils as openai_utils
+
+    monkeypatch.setattr(
+        openai_utils, "_get_encoding", lambda name: WhitespaceEncoding()
+    )
+    count_tokens = openai_token_counter("engines/davinci/completions", "fake_base")
+    request = {"prompt": "three word prompt", "max_tokens": 5}
+    assert count_tokens(request) == 8
+
+    with pytest.raises(NotImplementedError):
+        openai_token_counter("images/generations", "fake_base")
@@ -1,5 +1,9 @@
+import asyncio
+import json
 import os
+import shelve
 from pathlib import Path
+import aiohttp
 import pytest
 from parareq.parareq import (
     OpenAISettings,
@@ -7,7 +11,10 @@ from parareq.parareq import (
     StatusTracker,
     APIRequest,
     APIRequestProcessor,
+    BackgroundWriter,
+    RetryQueue,
 )
+from parareq.utils import JsonlWriter
 
 
 def test_openai_settings_init():
@@ -51,6 +58,8 @@ def test_init_api_req_proc_defaults(mock_environment):
 
     assert instance.api_key == "mock_api_key"
     assert instance.save_filepath == "parareq_results.jsonl"
+    # five seconds of requests at 2,625 per minute
+    assert instance.max_inflight == 218
     # Add more assertions for other default values
 
 
@@ -65,3 +74,527 @@ def test_init_api_req_proc_custom_values(mock_environment):
     assert instance.api_key == "custom_key"
     assert instance.save_filepath == "custom_filepath"
     # Add more assertions for other custom values
+
+
+class FakeResponse:
+    """Minimal stand-in for an aiohttp response context manager."""
+
+    def __init__(self, payload, headers=None, status=200):
+        self.payload = payload
+        self.headers = headers or {}
+        self.status = status
+
+    async def read(self):
+        if isinstance(self.payload, bytes):
+            return self.payload
+        return json.dumps(self.payload).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """Records posts and returns a canned payload, like a shared ClientSession."""
+
+    def __init__(self, payload, headers=None, status=200):
+        self.payload = payload
+        self.headers = headers
+        self.status = status
+        self.posts = []
+
+    def post(self, url, data):
+        self.posts.append((url, json.loads(data)))
+        return FakeResponse(self.payload, self.headers, self.status)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    """Patch the processor's ClientSession so runs never touch the network."""
+    session = FakeSession({"data": "ok"})
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    return session
+
+
+def dummy_processor(save_filepath, **kwargs):
+    return APIRequestProcessor(
+        api_key="xyz",
+        which_api="dummy",
+        request_url="http://127.0.0.1:5000/api",
+        save_filepath=save_filepath,
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+async def test_apirequest_call_api_uses_shared_session():
+    session = FakeSession({"data": [1, 2, 3]})
+    tracker = StatusTracker()
+    requests = [
+        APIRequest(
+            task_id=i,
+            request_json={"input": f"hello {i}"},
+            token_consumption=1,
+            attempts_left=1,
+            metadata=None,
+            write_to_file=False,
+        )
+        for i in range(3)
+    ]
+    for api_request in requests:
+        tracker.task_started()
+        await api_request.call_api(
+            session=session,
+            request_url="https://example.com/v1/embeddings",
+            retry_queue=None,
+            writer=None,
+            status_tracker=tracker,
+        )
+
+    assert len(session.posts) == 3
+    assert session.posts[0] == (
+        "https://example.com/v1/embeddings",
+        {"input": "hello 0"},
+    )
+    assert tracker.num_tasks_succeeded == 3
+    assert tracker.num_tasks_in_progress == 0
+
+
+def test_rate_limit_headers_clamp_limiters():
+    processor = APIRequestProcessor(
+        api_key="xyz", max_requests_per_minute=100, max_tokens_per_minute=1000
+    )
+    processor._apply_rate_limit_headers(
+        {
+            "x-ratelimit-remaining-requests": "10",
+            "x-ratelimit-reset-requests": "1m",
+            "x-ratelimit-remaining-tokens": "not-a-number",
+        }
+    )
+
+    assert processor.request_limiter.current_capacity <= 10
+    assert processor.token_limiter.current_capacity == 1000
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_error_records_retry_after():
+    session = FakeSession(
+        {"error": {"message": "Too many requests"}},
+        headers={"retry-after": "2"},
+        status=429,
+    )
+    tracker = StatusTracker()
+    tracker.task_started()
+    api_request = APIRequest(
+        task_id=0,
+        request_json={"input": "hello"},
+        token_consumption=1,
+        attempts_left=0,
+        metadata=None,
+        write_to_file=False,
+    )
+    await api_request.call_api(
+        session=session,
+        request_url="https://example.com/v1/embeddings",
+        retry_queue=None,
+        writer=None,
+        status_tracker=tracker,
+    )
+
+    assert tracker.num_rate_limit_errors == 1
+    assert tracker.retry_after == 2.0
+    assert tracker.num_tasks_failed == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("body", [b"", b"<html>Too Many Requests</html>"])
+async def test_rate_limit_error_without_json_body(body):
+    session = FakeSession(body, headers={"retry-after": "3"}, status=429)
+    tracker = StatusTracker()
+    tracker.task_started()
+    api_request = APIRequest(
+        task_id=0,
+        request_json={"input": "hello"},
+        token_consumption=1,
+        attempts_left=0,
+        metadata=None,
+        write_to_file=False,
+    )
+    await api_request.call_api(
+        session=session,
+        request_url="https://example.com/v1/embeddings",
+        retry_queue=None,
+        writer=None,
+        status_tracker=tracker,
+    )
+
+    assert tracker.num_rate_limit_errors == 1
+    assert tracker.num_other_errors == 0
+    assert tracker.retry_after == 3.0
+    assert tracker.num_tasks_failed == 1
+    assert api_request.result == [body.decode() or "HTTP 429"]
+
+
+@pytest.mark.asyncio
+async def test_error_status_fails_without_error_key():
+    session = FakeSession({"detail": "Service Unavailable"}, status=503)
+    tracker = StatusTracker()
+    tracker.task_started()
+    api_request = APIRequest(
+        task_id=0,
+        request_json={"input": "hello"},
+        token_consumption=1,
+        attempts_left=0,
+        metadata=None,
+        write_to_file=False,
+    )
+    await api_request.call_api(
+        session=session,
+        request_url="https://example.com/v1/embeddings",
+        retry_queue=None,
+        writer=None,
+        status_tracker=tracker,
+    )
+
+    assert tracker.num_api_errors == 1
+    assert tracker.num_tasks_succeeded == 0
+    assert tracker.num_tasks_failed == 1
+    assert api_request.result == [str({"detail": "Service Unavailable"})]
+
+
+class FailingSession(FakeSession):
+    """Every post fails with the given exception before a response arrives."""
+
+    def __init__(self, exception):
+        super().__init__({})
+        self.exception = exception
+
+    def post(self, url, data):
+        self.posts.append((url, json.loads(data)))
+        session = self
+
+        class FailingResponse(FakeResponse):
+            async def __aenter__(self):
+                raise session.exception
+
+        return FailingResponse(self.payload)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "exception",
+    [asyncio.TimeoutError(), aiohttp.ClientConnectionError("connection reset")],
+)
+async def test_failed_request_is_retried(exception):
+    tracker = StatusTracker()
+    tracker.task_started()
+    retry_queue = RetryQueue()
+    api_request = APIRequest(
+        task_id=0,
+        request_json={"input": "hello"},
+        token_consumption=1,
+        attempts_left=1,
+        metadata=None,
+    )
+    await api_request.call_api(
+        session=FailingSession(exception),
+        request_url="https://example.com/v1/embeddings",
+        retry_queue=retry_queue,
+        writer=None,
+        status_tracker=tracker,
+    )
+
+    assert tracker.num_other_errors == 1
+    assert len(retry_queue) == 1
+    assert tracker.num_tasks_in_progress == 1
+
+
+def test_run_with_cache_skips_answered_requests(fake_session, tmp_path):
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text('{"input": "a"}\n{"input": "b", "metadata": {"row": 1}}\n')
+    save_filepath = str(tmp_path / "results.jsonl")
+
+    first = dummy_processor(save_filepath, use_cache=True)
+    first.run(str(requests_file))
+    second = dummy_processor(save_filepath, use_cache=True)
+    second.run(str(requests_file))
+
+    # the second run is answered entirely from the cache
+    assert len(fake_session.posts) == 2
+    assert second.save_filepath != first.save_filepath
+    first_results = Path(first.save_filepath).read_text().splitlines()
+    second_results = Path(second.save_filepath).read_text().splitlines()
+    assert sorted(first_results) == sorted(second_results)
+    assert len(second_results) == 2
+    # every row has the same [request, response, metadata] shape
+    rows = sorted((json.loads(line) for line in first_results), key=str)
+    assert [len(row) for row in rows] == [3, 3]
+    assert sorted(row[2] is None for row in rows) == [False, True]
+
+
+class SlowSession(FakeSession):
+    """Holds every response open briefly and records peak concurrency."""
+
+    def __init__(self, payload):
+        super().__init__(payload)
+        self.open_responses = 0
+        self.peak_open_responses = 0
+
+    def post(self, url, data):
+        self.posts.append((url, json.loads(data)))
+        session = self
+
+        class SlowResponse(FakeResponse):
+            async def __aenter__(self):
+                session.open_responses += 1
+                session.peak_open_responses = max(
+                    session.peak_open_responses, session.open_responses
+                )
+                await asyncio.sleep(0.01)
+                return self
+
+            async def __aexit__(self, *exc_info):
+                session.open_responses -= 1
+                return False
+
+        return SlowResponse(self.payload)
+
+
+def test_run_bounds_requests_in_flight(monkeypatch, tmp_path):
+    session = SlowSession({"data": "ok"})
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text("".join(f'{{"input": "{i}"}}\n' for i in range(20)))
+
+    processor = dummy_processor(str(tmp_path / "results.jsonl"), max_inflight=3)
+    processor.run(str(requests_file))
+
+    assert len(session.posts) == 20
+    assert session.peak_open_responses == 3
+
+
+def test_retry_queue_returns_requests_once_due(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("parareq.parareq.time.monotonic", lambda: now[0])
+    queue = RetryQueue()
+    late, soon = (
+        APIRequest(
+            task_id=i,
+            request_json={},
+            token_consumption=0,
+            attempts_left=1,
+            metadata=None,
+        )
+        for i in range(2)
+    )
+    queue.put(late, delay=2)
+    queue.put(soon, delay=1)
+
+    assert queue.pop_due() is None
+    now[0] += 1
+    assert queue.pop_due() is soon
+    assert queue.pop_due() is None
+    now[0] += 1
+    assert queue.pop_due() is late
+    assert len(queue) == 0
+
+
+def test_run_raises_on_malformed_request_line(fake_session, tmp_path):
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text('{"input": "a"}\nnot json\n')
+
+    processor = dummy_processor(str(tmp_path / "results.jsonl"))
+    with pytest.raises(ValueError):
+        processor.run(str(requests_file))
+
+
+def test_retry_queue_reports_time_until_due(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("parareq.parareq.time.monotonic", lambda: now[0])
+    queue = RetryQueue()
+    assert queue.seconds_until_due() is None
+    queue.put(
+        APIRequest(
+            task_id=0,
+            request_json={},
+            token_consumption=0,
+            attempts_left=1,
+            metadata=None,
+        ),
+        delay=2,
+    )
+    assert queue.seconds_until_due() == 2
+    now[0] += 3
+    assert queue.seconds_until_due() == 0
+
+
+def test_rate_limit_cooldown_gates_dispatch_and_logs_once(monkeypatch, caplog):
+    now = [100.0]
+    monkeypatch.setattr("parareq.parareq.time.monotonic", lambda: now[0])
+    processor = dummy_processor("results.jsonl")
+    tracker = StatusTracker()
+    assert processor._cooldown_remaining(tracker) == 0
+    tracker.had_rate_limit_error(retry_after=10)
+
+    with caplog.at_level("WARNING", logger="parareq.parareq"):
+        assert processor._cooldown_remaining(tracker) == 10
+        now[0] += 4
+        assert processor._cooldown_remaining(tracker) == 6
+        now[0] += 6
+        assert processor._cooldown_remaining(tracker) == 0
+
+    assert caplog.text.count("Pausing to cool down") == 1
+
+
+@pytest.mark.asyncio
+async def test_background_writer_writes_all_rows_on_exit(tmp_path):
+    save_filepath = tmp_path / "results.jsonl"
+    with JsonlWriter(str(save_filepath)) as file_writer:
+        async with BackgroundWriter(file_writer) as writer:
+            for i in range(100):
+                writer.write([{"input": i}, {"data": "ok"}])
+                if i % 10 == 0:
+                    await asyncio.sleep(0)
+
+    rows = [json.loads(line) for line in save_filepath.read_text().splitlines()]
+    assert rows == [[{"input": i}, {"data": "ok"}] for i in range(100)]
+
+
+@pytest.mark.asyncio
+async def test_background_writer_flushes_idle_rows(tmp_path):
+    save_filepath = tmp_path / "results.jsonl"
+    with JsonlWriter(str(save_filepath)) as file_writer:
+        async with BackgroundWriter(file_writer, flush_interval=0.01) as writer:
+            writer.write([{"input": 0}, {"data": "ok"}])
+            await asyncio.sleep(0.1)
+            # visible on disk while the writer is still open
+            assert save_filepath.read_text().count("\n") == 1
+
+
+def test_run_with_failures_renames_results_file(monkeypatch, tmp_path):
+    session = FakeSession({"error": {"message": "boom"}}, status=500)
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text('{"input": "a"}\n')
+
+    processor = dummy_processor(str(tmp_path / "results.jsonl"), max_attempts=1)
+    processor.run(str(requests_file))
+
+    assert processor.save_filepath == str(tmp_path / "results_with_errors.jsonl")
+    assert not (tmp_path / "results.jsonl").exists()
+    [row] = [json.loads(line) for line in Path(processor.save_filepath).open()]
+    assert row[0] == {"input": "a"}
+
+
+def test_run_raises_unhandled_call_errors(monkeypatch, tmp_path):
+    session = FailingSession(RuntimeError("bug"))
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text('{"input": "a"}\n{"input": "b"}\n')
+
+    processor = dummy_processor(str(tmp_path / "results.jsonl"))
+    with pytest.raises(RuntimeError, match="bug"):
+        processor.run(str(requests_file))
+
+
+def test_run_sleeps_while_waiting_for_a_slot(monkeypatch, tmp_path):
+    """A due retry must not make the loop spin while every slot is taken."""
+    monkeypatch.setattr("parareq.parareq.RETRY_BACKOFF_SECONDS", 0.05)
+    monkeypatch.setattr("parareq.parareq.RETRY_JITTER_SECONDS", 0)
+    session = FakeSession({"data": "ok"})
+    failed = []
+
+    def post(url, data):
+        request_json = json.loads(data)
+        session.posts.append((url, request_json))
+
+        class ScriptedResponse(FakeResponse):
+            async def __aenter__(self):
+                if request_json["input"] == "a" and not failed:
+                    failed.append(request_json)
+                    raise aiohttp.ClientError("first attempt fails")
+                if request_json["input"] == "b":
+                    await asyncio.sleep(0.3)  # holds the only slot
+                return self
+
+        return ScriptedResponse(session.payload)
+
+    session.post = post
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    waits = []
+    wait_for_wakeup = APIRequestProcessor._wait_for_wakeup
+
+    async def counting_wait(wakeup, timeout):
+        waits.append(timeout)
+        await wait_for_wakeup(wakeup, timeout)
+
+    monkeypatch.setattr(
+        APIRequestProcessor, "_wait_for_wakeup", staticmethod(counting_wait)
+    )
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text('{"input": "a"}\n{"input": "b"}\n{"input": "c"}\n')
+
+    processor = dummy_processor(str(tmp_path / "results.jsonl"), max_inflight=1)
+    processor.run(str(requests_file))
+
+    assert len(session.posts) == 4
+    assert len(waits) < 50
+
+
+def test_failed_runs_never_overwrite_each_others_errors(monkeypatch, tmp_path):
+    session = FakeSession({"error": {"message": "boom"}}, status=500)
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    save_filepath = str(tmp_path / "results.jsonl")
+
+    error_files = []
+    for run in ("first", "second"):
+        requests_file = tmp_path / f"{run}.jsonl"
+        requests_file.write_text(f'{{"input": "{run}"}}\n')
+        processor = dummy_processor(save_filepath, max_attempts=1)
+        processor.run(str(requests_file))
+        error_files.append(processor.save_filepath)
+
+    assert error_files == [
+        str(tmp_path / "results_with_errors.jsonl"),
+        str(tmp_path / "results_with_errors_1.jsonl"),
+    ]
+    for run, filename in zip(("first", "second"), error_files):
+        [row] = [json.loads(line) for line in Path(filename).open()]
+        assert row[0] == {"input": run}
+
+
+def test_run_with_cache_skips_non_2xx_responses(monkeypatch, tmp_path):
+    session = FakeSession({"detail": "Service Unavailable"}, status=503)
+    monkeypatch.setattr(
+        "parareq.parareq.aiohttp.ClientSession", lambda **kwargs: session
+    )
+    requests_file = tmp_path / "requests.jsonl"
+    requests_file.write_text('{"input": "a"}\n')
+
+    processor = dummy_processor(
+        str(tmp_path / "results.jsonl"), use_cache=True, max_attempts=1
+    )
+    processor.run(str(requests_file))
+
+    with shelve.open(processor.cache_filepath) as cache:
+        assert len(cache) == 0
@@ -1,3 +1,5 @@
+import pytest
+
 from parareq.rate_limiter import RateLimiter
 
 
@@ -5,3 +7,62 @@ def test_ratelimiter_init():
     """test the basic rate limiter initialization."""
     limiter = RateLimiter(limit=100, period=10)
     assert limiter.current_capacity == 100.0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ratelimiter_refills_lazily_up_to_limit(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("parareq.rate_limiter.time.monotonic", clock)
+    limiter = RateLimiter(limit=60, period=60)  # 1 unit per second
+
+    limiter.update_usage(60)
+    assert limiter.wait_time(1) == 1.0
+
+    clock.now += 0.5
+    assert limiter.wait_time(1) == 0.5
+
+    clock.now += 0.5
+    assert limiter.wait_time(1) == 0.0
+
+    # refills never exceed the bucket size
+    clock.now += 3600
+    limiter.update_allowance()
+    assert limiter.current_capacity == 60
+
+
+def test_ratelimiter_oversized_request_waits_for_full_bucket(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("parareq.rate_limiter.time.monotonic", clock)
+    limiter = RateLimiter(limit=10, period=10)
+
+    limiter.update_usage(10)
+    assert limiter.wait_time(50) == 10.0
+
+
+def test_ratelimiter_sync_remaining_holds_until_reset(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("parareq.rate_limiter.time.monotonic", clock)
+    limiter = RateLimiter(limit=60, period=60)
+
+    limiter.sync_remaining(30)
+    assert limiter.current_capacity == 30
+
+    limiter.sync_remaining(0, reset_seconds=5)
+    assert limiter.wait_time(1) == pytest.approx(5.0)
+
+
+def test_ratelimiter_uses_given_time(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("parareq.rate_limiter.time.monotonic", clock)
+    limiter = RateLimiter(limit=60, period=60)
+
+    limiter.update_usage(60)
+    # a shared clock reading is used instead of reading the clock again
+    assert limiter.wait_time(1, now=clock.now + 0.25) == 0.75
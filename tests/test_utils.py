@@ -1,22 +1,111 @@
 import json
-from unittest.mock import mock_open, patch
+import os
 import pytest
-from parareq.utils import append_to_jsonl
+from parareq import utils
+from parareq.utils import (
+    append_many_to_jsonl,
+    append_to_jsonl,
+    iter_jsonl,
+    JsonlWriter,
+    nonduplicate_filename,
+    parse_retry_after,
+    request_cache_key,
+)
 
 
-def test_append_to_jsonl():
-    # Define test data
-    data = {"key": "value"}
-    filename = "test_file.jsonl"
+def test_append_to_jsonl(tmp_path):
+    filename = str(tmp_path / "test_file.jsonl")
 
-    # Mock the open function to avoid writing to an actual file
-    with patch("builtins.open", mock_open()) as mock_file:
-        # Call the function being tested
-        append_to_jsonl(data, filename)
+    append_to_jsonl({"key": "value"}, filename)
+    append_to_jsonl([1, None], filename)
 
-        # Assert that the open function was called with the correct arguments
-        mock_file.assert_called_once_with(filename, "a")
+    with open(filename, "rb") as f:
+        assert f.read() == b'{"key":"value"}\n[1,null]\n'
 
-        # Assert that the write method was called with the correct argument
-        expected_json_string = json.dumps(data) + "\n"
-        mock_file().write.assert_called_once_with(expected_json_string)
+
+def test_append_many_to_jsonl(tmp_path):
+    filename = str(tmp_path / "test_file.jsonl")
+
+    append_many_to_jsonl([], filename)
+    assert not os.path.exists(filename)
+
+    append_to_jsonl({"row": 0}, filename)
+    append_many_to_jsonl(({"row": i} for i in range(1, 4)), filename)
+
+    rows = list(iter_jsonl(filename))
+    assert rows == [{"row": i} for i in range(4)]
+
+
+def test_iter_jsonl_splits_lines_across_chunks(tmp_path):
+    requests_file = tmp_path / "requests.jsonl"
+    rows = [{"input": "hello", "metadata": {"row_id": i}} for i in range(5)]
+    # blank line in the middle and no trailing newline at the end
+    content = "\n".join(json.dumps(row) for row in rows[:2])
+    content += "\n\n" + "\n".join(json.dumps(row) for row in rows[2:])
+    requests_file.write_text(content)
+
+    assert list(iter_jsonl(str(requests_file), chunk_size=7)) == rows
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after(None) is None
+    # HTTP-date values are not supported and fall back to the default pause
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") is None
+
+
+def test_jsonl_writer_batches_and_flushes_on_close(tmp_path):
+    filename = tmp_path / "results.jsonl"
+    rows = [[{"input": "hello"}, {"data": i}] for i in range(5)]
+
+    with JsonlWriter(str(filename), batch_size=2) as writer:
+        for row in rows:
+            writer.write(row)
+
+    assert list(iter_jsonl(str(filename))) == rows
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_jsonl_line_is_compact(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(utils, "orjson", None)
+    data = [{"input": "café"}, {"row": 1}, None]
+    expected = '[{"input":"café"},{"row":1},null]'.encode()
+
+    assert utils.json_dumps(data) == expected
+    assert utils.dumps_jsonl_line(data) == expected + b"\n"
+
+
+def test_nonduplicate_filename_claims_a_free_name(tmp_path):
+    filename = str(tmp_path / "results.jsonl")
+    assert nonduplicate_filename(filename) == filename
+
+    claimed = [nonduplicate_filename(filename, create=True) for _ in range(3)]
+    assert claimed == [
+        filename,
+        str(tmp_path / "results_1.jsonl"),
+        str(tmp_path / "results_2.jsonl"),
+    ]
+    assert all(os.path.exists(name) for name in claimed)
+    assert nonduplicate_filename(filename) == str(tmp_path / "results_3.jsonl")
+
+
+def test_create_requests_file_matches_json_serialization(tmp_path):
+    filename = tmp_path / "requests.jsonl"
+    utils.create_requests_file(str(filename))
+
+    lines = filename.read_bytes().splitlines(keepends=True)
+    assert len(lines) == 10_000
+    for x in (0, 9, 10, 9_999):
+        job = {"model": "text-embedding-ada-002", "input": f"{x}\n"}
+        assert lines[x] == utils.dumps_jsonl_line(job)
+
+
+def test_request_cache_key_depends_on_url_and_body():
+    url = "https://api.openai.com/v1/embeddings"
+    key = request_cache_key(url, {"model": "m", "input": "a"})
+
+    assert request_cache_key(url, {"input": "a", "model": "m"}) == key
+    assert request_cache_key(url, {"model": "m", "input": "b"}) != key
+    other_url = "https://api.example.com/v2/embeddings"
+    assert request_cache_key(other_url, {"model": "m", "input": "a"}) != key